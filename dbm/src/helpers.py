@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 from __future__ import annotations
 
+import io
 import os
+import shutil
 import subprocess
 import sys
+import threading
 import traceback
+import weakref
 
 from contextlib import nullcontext
-from functools import wraps
-from tempfile import TemporaryDirectory
+from datetime import datetime
+from functools import lru_cache, wraps
+from tempfile import mkdtemp
 from pathlib import Path
-from typing import Union, TextIO
+from typing import Callable, Iterable, Union, TextIO
 
 import click
 import pandas as pd
@@ -19,6 +24,10 @@ DEFAULT_VERBOSITY = 2
 PREFIX_RUN = "[RUN] "
 PREFIX_ERROR = "[ERROR] "
 DONE_MESSAGE = "[SUCCESS]"
+LOG_BUFFER_SIZE = 1 << 17  # 128 KiB
+LOG_FLUSH_THRESHOLD = 1 << 16  # 64 KiB
+LOG_FLUSH_INTERVAL = 1.0  # seconds
+TIMESTAMP_FORMAT = "%a %b %e %H:%M:%S %Z %Y"
 
 EXT_NIFTI = ".nii"
 EXT_GZIP = ".gz"
@@ -48,6 +57,16 @@ DNAME_TEMPLATE_MAP = {
 
 DNAME_NIHPD = "nihpd_pipeline"
 
+# bound once to skip attribute lookups when echoing many lines
+_CLICK_STYLE = click.style
+_CLICK_ECHO = click.echo
+
+# program name -> whether it was found on the PATH
+_PROG_CACHE: dict[str, bool] = {}
+
+# PYTHONPATH value -> whether it contains the nihpd pipeline
+_PYTHONPATH_OK_CACHE: dict[str, bool] = {}
+
 def add_dbm_minc_options():
     dbm_minc_options = [
         click.option(
@@ -111,6 +130,24 @@ def add_dbm_minc_options():
     ]
     return add_options(dbm_minc_options)
 
+def _format_timestamp() -> str:
+    return datetime.now().astimezone().strftime(TIMESTAMP_FORMAT)
+
+
+def _path_exists(path: Union[str, os.PathLike]) -> bool:
+    # other errors (e.g. PermissionError) are raised, like Path.exists()
+    try:
+        os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    return True
+
+
+def _as_path(path: Union[str, os.PathLike]) -> Path:
+    # avoid re-parsing paths that are already Path objects
+    return path if isinstance(path, Path) else Path(path)
+
+
 def add_suffix(
     path: Union[Path, str],
     suffix: str,
@@ -118,7 +155,7 @@ def add_suffix(
     ext: Union[str, None] = None,
 ) -> Path:
 
-    path = Path(path)
+    path = _as_path(path)
     if sep is not None:
         if suffix.startswith(sep):
             suffix = suffix[len(sep) :]
@@ -126,20 +163,25 @@ def add_suffix(
         sep = ""
 
     if ext is not None:
-        stem = str(path).removesuffix(ext)
+        name = path.name
+        stem = name[: -len(ext)] if (ext and name.endswith(ext)) else name
     else:
         stem = path.stem
         ext = path.suffix
 
-    return path.parent / f"{stem}{sep}{suffix}{ext}"
+    name_new = f"{stem}{sep}{suffix}{ext}"
+    # with_name() does not accept paths with an empty name like "." or "/"
+    if path.name == "":
+        return path.parent / name_new
+    return path.with_name(name_new)
 
 
 def check_program(program, program_name=None):
     if program_name is None:
         program_name = program
-    try:
-        subprocess.check_output(['which', program])
-    except subprocess.CalledProcessError:
+    if program not in _PROG_CACHE:
+        _PROG_CACHE[program] = shutil.which(program) is not None
+    if not _PROG_CACHE[program]:
         raise RuntimeError(
             f"This function requires {program_name}, "
             "which does not appear to be installed",
@@ -164,8 +206,22 @@ def minc_qc(helper: ScriptHelper, fpath, fpath_qc, fpath_mask, title, silent=Fal
     )
 
 
+@lru_cache(maxsize=32)
+def _load_list_cached(fpath: str, mtime_ns: int, names: Union[tuple, None]) -> pd.DataFrame:
+    # mtime_ns is only part of the cache key, so that modified files are reloaded
+    return pd.read_csv(
+        fpath, header=None, dtype=str, names=list(names) if names else None
+    )
+
+
 def load_list(fpath: Path | str, names=None) -> pd.DataFrame:
-    return pd.read_csv(fpath, header=None, dtype=str, names=names)
+    fpath = _as_path(fpath)
+    # return a copy so that callers cannot modify the cached dataframe
+    return _load_list_cached(
+        os.fspath(fpath.resolve()),
+        fpath.stat().st_mtime_ns,
+        tuple(names) if names else None,
+    ).copy()
 
 
 def requires_program(func, program, program_name=None):
@@ -173,8 +229,8 @@ def requires_program(func, program, program_name=None):
     @wraps(func)
     def _requires_program(*args, **kwargs):
         check_program(program, program_name)
-        func(*args, **kwargs)
-        
+        return func(*args, **kwargs)
+
     return _requires_program
 
 
@@ -188,15 +244,28 @@ def check_nihpd_pipeline(dpath_pipeline):
     if not Path(fpath_to_source).exists():
         raise FileNotFoundError(fpath_to_source)
     
-    pythonpath = os.environ.get('PYTHONPATH')
-    if (pythonpath is None) or not DNAME_NIHPD in pythonpath:
+    pythonpath = os.environ.get('PYTHONPATH', '')
+    pythonpath_ok = _PYTHONPATH_OK_CACHE.get(pythonpath)
+    if pythonpath_ok is None:
+        # match whole directory names, not substrings
+        pythonpath_ok = any(
+            DNAME_NIHPD in entry.split(os.sep)
+            for entry in pythonpath.split(os.pathsep)
+        )
+        _PYTHONPATH_OK_CACHE[pythonpath] = pythonpath_ok
+    if not pythonpath_ok:
         raise RuntimeError(
             "PYTHONPATH environment variable not set correctly. "
             f"Make sure to source {fpath_to_source} before running")
 
 
-def process_path(path: str) -> Path:
-    return Path(path).expanduser().resolve()
+def process_path(path: Union[str, Path]) -> Path:
+    path = _as_path(path)
+    # absolute paths without ".." only need to be normalized, not resolved
+    # component by component (collapsing ".." as text is wrong after a symlink)
+    if path.is_absolute() and (".." not in path.parts):
+        return Path(os.path.normpath(path))
+    return path.expanduser().resolve()
 
 
 def add_options(options):
@@ -209,50 +278,11 @@ def add_options(options):
 
 
 def add_helper_options():
-    common_options = [
-        click.option(
-            "--logfile", "fpath_log", callback=callback_path, help="Path to log file"
-        ),
-        click.option(
-            "--log-append/--no-log-append", default=True, help="Whether to append instead of overwriting log file"
-        ),
-        click.option(
-            "--overwrite/--no-overwrite",
-            default=False,
-            help="Overwrite existing result files.",
-        ),
-        click.option(
-            "--dry-run/--no-dry-run",
-            default=False,
-            help="Print shell commands without executing them.",
-        ),
-        click.option(
-            "-v",
-            "--verbose",
-            "verbosity",
-            count=True,
-            default=DEFAULT_VERBOSITY,
-            help="Set/increase verbosity level (cumulative). "
-            f"Default level: {DEFAULT_VERBOSITY}.",
-        ),
-        click.option(
-            "--quiet",
-            is_flag=True,
-            default=False,
-            help="Suppress output whenever possible. "
-            "Has priority over -v/--verbose flags.",
-        ),
-    ]
-    return add_options(common_options)
+    return _HELPER_OPTIONS
 
 
 def add_silent_option():
-    return add_options([
-        click.option(
-            "--silence-commands/--no-silence-commands", "silent", 
-            default=True, 
-            help="Whether to silence intermediate shell command outputs")
-    ])
+    return _SILENT_OPTION
 
 
 def callback_path(ctx, param, value):
@@ -261,6 +291,50 @@ def callback_path(ctx, param, value):
     return process_path(value)
 
 
+# built once at import time since the decorators can be reused
+_HELPER_OPTIONS = add_options([
+    click.option(
+        "--logfile", "fpath_log", callback=callback_path, help="Path to log file"
+    ),
+    click.option(
+        "--log-append/--no-log-append", default=True, help="Whether to append instead of overwriting log file"
+    ),
+    click.option(
+        "--overwrite/--no-overwrite",
+        default=False,
+        help="Overwrite existing result files.",
+    ),
+    click.option(
+        "--dry-run/--no-dry-run",
+        default=False,
+        help="Print shell commands without executing them.",
+    ),
+    click.option(
+        "-v",
+        "--verbose",
+        "verbosity",
+        count=True,
+        default=DEFAULT_VERBOSITY,
+        help="Set/increase verbosity level (cumulative). "
+        f"Default level: {DEFAULT_VERBOSITY}.",
+    ),
+    click.option(
+        "--quiet",
+        is_flag=True,
+        default=False,
+        help="Suppress output whenever possible. "
+        "Has priority over -v/--verbose flags.",
+    ),
+])
+
+_SILENT_OPTION = add_options([
+    click.option(
+        "--silence-commands/--no-silence-commands", "silent", 
+        default=True, 
+        help="Whether to silence intermediate shell command outputs")
+])
+
+
 def with_helper(func):
     @wraps(func)
     def _with_helper(
@@ -280,48 +354,71 @@ def with_helper(func):
         if with_log:
             fpath_log.parent.mkdir(parents=True, exist_ok=True)
 
-        with TemporaryDirectory() as dpath_tmp:
-            if log_append:
-                mode = "a"
-            else:
-                mode = "w"
-            with fpath_log.open(mode) if with_log else nullcontext() as file_log:
-                helper = ScriptHelper(
-                    file_log=file_log,
-                    verbosity=verbosity,
-                    quiet=quiet,
-                    dry_run=dry_run,
-                    overwrite=overwrite,
-                    prefix_run=prefix_run,
-                    prefix_error=prefix_error,
-                    dpath_tmp=Path(dpath_tmp),
-                )
-                try:
-                    helper.timestamp()
-                    helper.print_separation()
+        if log_append:
+            mode = "a"
+        else:
+            mode = "w"
+        with (
+            # surrogateescape lets command output that is not valid text
+            # pass through to the log file unchanged
+            open(
+                fpath_log,
+                mode,
+                buffering=LOG_BUFFER_SIZE,
+                errors="surrogateescape",
+            )
+            if with_log
+            else nullcontext()
+        ) as file_log:
+            helper = ScriptHelper(
+                file_log=file_log,
+                verbosity=verbosity,
+                quiet=quiet,
+                dry_run=dry_run,
+                overwrite=overwrite,
+                prefix_run=prefix_run,
+                prefix_error=prefix_error,
+            )
+            try:
+                helper.print_header()
 
-                    func(helper=helper, **kwargs)
+                func(helper=helper, **kwargs)
 
-                    for callback in helper.callbacks_success:
+                callbacks_success = helper.callbacks_success
+                if callbacks_success:
+                    for callback in callbacks_success:
                         callback()
 
-                    helper.done()
+                helper.done()
 
-                except Exception as ex:
+            except Exception as ex:
 
-                    for callback in helper.callback_failure:
+                callbacks_failure = helper.callbacks_failure
+                if callbacks_failure:
+                    for callback in callbacks_failure:
                         callback()
 
-                    helper.print_error(traceback.format_exc(), exit=exit_on_error)
-                    raise ex
+                # only walk the stack if the full traceback will be shown
+                if helper.verbose:
+                    message_error = traceback.format_exc()
+                else:
+                    message_error = f"{type(ex).__name__}: {ex}"
+                helper.print_error(message_error, exit=exit_on_error)
+                raise ex
 
-                finally:
+            finally:
 
-                    for callback in helper.callbacks_always:
+                callbacks_always = helper.callbacks_always
+                if callbacks_always:
+                    for callback in callbacks_always:
                         callback()
 
-                    helper.print_separation()
-                    helper.timestamp()
+                # close() also removes the temporary directory, so it must
+                # run even if writing the footer fails
+                try:
+                    helper.print_footer()
+                finally:
+                    helper.close()
 
     return _with_helper
 
@@ -389,6 +486,59 @@ def check_dbm_inputs(func):
     return _check_dbm_inputs
 
 
+class _LogBuffer:
+    """Pending log file output, written out in large chunks.
+
+    Output is written once LOG_FLUSH_THRESHOLD characters have accumulated,
+    LOG_FLUSH_INTERVAL seconds after the first pending line, or on flush().
+    """
+
+    def __init__(self, file_log: TextIO) -> None:
+        self.file_log = file_log
+        self._lines: list[str] = []
+        self._n_chars = 0
+        self._lock = threading.Lock()
+        self._timer: Union[None, threading.Timer] = None
+        self._closed = False
+
+    def write(self, text: str):
+        with self._lock:
+            self._lines.append(text)
+            self._n_chars += len(text)
+            if self._closed or (self._n_chars > LOG_FLUSH_THRESHOLD):
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(LOG_FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            # a timer that fired while close() held the lock does nothing
+            if not self._closed:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            try:
+                self._flush()
+            finally:
+                self._closed = True
+
+    def _flush(self):
+        # caller must hold self._lock
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.file_log.closed:
+            return
+        if self._lines:
+            self.file_log.write("".join(self._lines))
+            self._lines = []
+            self._n_chars = 0
+        self.file_log.flush()
+
+
 class ScriptHelper:
     def __init__(
         self,
@@ -422,13 +572,35 @@ class ScriptHelper:
         self.quiet = quiet
         self.dry_run = dry_run
         self.overwrite = overwrite
-        self.dpath_tmp: Path = dpath_tmp
+        self._dpath_tmp: Union[None, Path] = dpath_tmp
+        self._finalizer_tmp = None
         self.prefix_run = prefix_run
         self.prefix_error = prefix_error
         self.done_message = done_message
-        self.callbacks_always: list = callbacks_always
-        self.callbacks_success: list = callbacks_success
-        self.callback_failure: list = callbacks_failure
+        self.callbacks_always: list[Callable] = callbacks_always
+        self.callbacks_success: list[Callable] = callbacks_success
+        self.callbacks_failure: list[Callable] = callbacks_failure
+
+        # pending log file output, written out by flush()/close()
+        self._log_is_tty = file_log is not None and file_log.isatty()
+        if file_log is not None and not self._log_is_tty:
+            self._log_buffer = _LogBuffer(file_log)
+            # also write it out at exit if close() is never called
+            self._finalizer_log = weakref.finalize(self, self._log_buffer.close)
+        else:
+            self._log_buffer = None
+            self._finalizer_log = None
+
+    @property
+    def dpath_tmp(self) -> Path:
+        """Temporary directory, created on first access."""
+        if self._dpath_tmp is None:
+            self._dpath_tmp = Path(mkdtemp())
+            # removed by close(), or when the helper is garbage collected
+            self._finalizer_tmp = weakref.finalize(
+                self, shutil.rmtree, self._dpath_tmp, ignore_errors=True
+            )
+        return self._dpath_tmp
 
     def verbose(self, threshold=0):
         return self.verbosity > threshold
@@ -459,19 +631,48 @@ class ScriptHelper:
             Color name, by default None
         color_prefix_only : bool, optional
             Whether to only color the prefix instead of the entire text, by default False
+        force_color : bool, optional
+            Whether to keep color codes in the output, by default True
         """
 
         # format text to print
-        if (prefix != "") and (color_prefix_only):
-            text = f"{click.style(prefix, fg=text_color)}{message}"
+        # (color codes would be stripped anyway if force_color is False)
+        if (text_color is None) or (not force_color):
+            text = f"{prefix}{message}" if prefix else str(message)
+        elif (prefix != "") and (color_prefix_only):
+            text = f"{_CLICK_STYLE(prefix, fg=text_color)}{message}"
         else:
-            text = click.style(f"{prefix}{message}", fg=text_color)
+            text = _CLICK_STYLE(f"{prefix}{message}", fg=text_color)
+
+        # interactive output is written immediately
+        file_log = self.file_log
+        if file_log is None or self._log_is_tty:
+            _CLICK_ECHO(text, color=force_color, file=file_log)
+            return
+
+        self._write_log(f"{text}\n")
 
-        click.echo(text, color=force_color, file=self.file_log)
+    def _write_log(self, text: str):
+        """Queue text for the (non-TTY) log file."""
+        self._log_buffer.write(text)
 
     def print_separation(self, symbol="-", length=20):
         self.echo(symbol * length)
 
+    def print_header(self, symbol="-", length=20):
+        """Print the current time followed by a separation line, in one write."""
+        if self.verbose:
+            self.echo(f"{_format_timestamp()}\n{symbol * length}")
+        else:
+            self.print_separation(symbol=symbol, length=length)
+
+    def print_footer(self, symbol="-", length=20):
+        """Print a separation line followed by the current time, in one write."""
+        if self.verbose:
+            self.echo(f"{symbol * length}\n{_format_timestamp()}")
+        else:
+            self.print_separation(symbol=symbol, length=length)
+
     def print_info(self, message="", text_color=None):
         if self.verbose:
             self.echo(message=message, text_color=text_color)
@@ -492,6 +693,7 @@ class ScriptHelper:
             Program return code, by default 1
         """
         self.echo(message, prefix=self.prefix_error, text_color=text_color)
+        self.flush()
         if exit:
             sys.exit(exit_code)
 
@@ -522,10 +724,9 @@ class ScriptHelper:
             Execute the command even if self.dry_run is True
         """
         args = [str(arg) for arg in args if arg != ""]
-        args_str = " ".join(args)
         if not silent and ((self.verbosity > 0) or self.dry_run):
             self.echo(
-                f"{args_str}",
+                " ".join(args),
                 prefix=PREFIX_RUN,
                 text_color="yellow",
                 color_prefix_only=self.dry_run,
@@ -540,37 +741,118 @@ class ScriptHelper:
             if stderr is None:
                 stderr = self.file_log
             try:
-                subprocess.run(
-                    args, check=True, shell=shell, stdout=stdout, stderr=stderr
-                )
+                if (
+                    self.file_log is not None
+                    and not self._log_is_tty
+                    and self.file_log in (stdout, stderr)
+                ):
+                    self._run_logged(args, shell=shell, stdout=stdout, stderr=stderr)
+                else:
+                    subprocess.run(
+                        args, check=True, shell=shell, stdout=stdout, stderr=stderr
+                    )
             except subprocess.CalledProcessError as ex:
                 raise RuntimeError(
-                    f"\nCommand {args_str} returned {ex.returncode}",
+                    f"\nCommand {' '.join(args)} returned {ex.returncode}",
                 )
 
+    def _run_logged(self, args: list[str], shell=False, stdout=None, stderr=None):
+        """Run a command, sending output meant for the log file through a pipe.
+
+        This keeps the log file with a single writer, so command output stays
+        in order with echoed messages and goes through the same buffer.
+        """
+        # only the stream going to the log file is read
+        if subprocess.PIPE in (stdout, stderr):
+            raise ValueError(
+                "subprocess.PIPE cannot be combined with the log file "
+                "since run_command does not return captured output"
+            )
+
+        if stdout is self.file_log:
+            stdout = subprocess.PIPE
+            if stderr is self.file_log:
+                stderr = subprocess.STDOUT
+        elif stderr is self.file_log:
+            stderr = subprocess.PIPE
+
+        with subprocess.Popen(
+            args,
+            shell=shell,
+            stdout=stdout,
+            stderr=stderr,
+        ) as process:
+            pipe = process.stdout if stdout == subprocess.PIPE else process.stderr
+            # decode like the log file encodes, and keep '\r' untranslated
+            # so that the output is written back byte for byte
+            lines = io.TextIOWrapper(
+                pipe,
+                encoding=self.file_log.encoding,
+                errors=self.file_log.errors,
+                newline="",
+            )
+            for line in lines:
+                self._write_log(line)
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
+
     def timestamp(self):
-        """Print the current time."""
-        self.run_command(["date"], force=True)
+        """Print the current time, in the same format as the date command."""
+        if self.verbose:
+            self.echo(_format_timestamp())
 
     def done(self):
         self.echo(self.done_message, text_color="green")
+        self.flush()
+
+    def flush(self):
+        """Write out any buffered log output."""
+        if self._log_buffer is not None:
+            self._log_buffer.flush()
+        elif self.file_log is not None and not self.file_log.closed:
+            self.file_log.flush()
+
+    def close(self):
+        """Write out buffered log output, stop buffering and remove the
+        temporary directory if one was created.
+
+        The log file itself is left open, since it belongs to the caller.
+        """
+        try:
+            if self._finalizer_log is not None:
+                self._finalizer_log()
+        finally:
+            if self._finalizer_tmp is not None:
+                self._finalizer_tmp()
 
     def mkdir(self, path: Union[str, Path], parents=True, exist_ok=None):
         if exist_ok is None:
             exist_ok = self.overwrite
         if not self.dry_run:
-            Path(path).mkdir(parents=parents, exist_ok=exist_ok)
+            _as_path(path).mkdir(parents=parents, exist_ok=exist_ok)
 
     def check_dir(self, dpath: Path, prefix=None):
-        if dpath.exists() and (not self.overwrite):
-
-            # get all files in directory
-            files_in_dir = [p for p in dpath.rglob("*") if p.is_file()]
-            # optionally keep only those with a specific prefix
-            if prefix is not None:
-                files_in_dir = [p for p in files_in_dir if p.name.startswith(prefix)]
+        if dpath.is_dir() and (not self.overwrite):
 
-            if len(files_in_dir) != 0:
+            def _iter_files(dpath_current):
+                # unreadable subdirectories are skipped, like with rglob()
+                try:
+                    entries = os.scandir(dpath_current)
+                except PermissionError:
+                    return
+                with entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            yield from _iter_files(entry.path)
+                        # optionally keep only those with a specific prefix
+                        elif entry.is_file() and (
+                            prefix is None or entry.name.startswith(prefix)
+                        ):
+                            yield entry
+
+            # stop at the first matching file
+            if next(_iter_files(dpath), None) is not None:
                 raise FileExistsError(
                     f"Directory {dpath} exists and/or contains expected result files. "
                     "Use --overwrite to overwrite."
@@ -578,6 +860,21 @@ class ScriptHelper:
 
         return dpath
 
-    def check_file(self, fpath: Path):
-        if fpath.exists() and not self.overwrite:
+    def check_file(self, fpath: Union[str, os.PathLike]):
+        if self.overwrite:
+            return
+        if _path_exists(fpath):
             raise FileExistsError(f"File {fpath} exists. Use --overwrite to overwrite.")
+
+    def check_files(self, fpaths: Iterable[Union[str, os.PathLike]], max_shown=5):
+        if self.overwrite:
+            return
+        fpaths_existing = [fpath for fpath in fpaths if _path_exists(fpath)]
+        if len(fpaths_existing) != 0:
+            fpaths_str = ", ".join(str(fpath) for fpath in fpaths_existing[:max_shown])
+            if len(fpaths_existing) > max_shown:
+                fpaths_str += ", ..."
+            raise FileExistsError(
+                f"{len(fpaths_existing)} files exist ({fpaths_str}). "
+                "Use --overwrite to overwrite."
+            )